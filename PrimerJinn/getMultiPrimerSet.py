@@ -6,9 +6,12 @@ from Bio.SeqRecord import SeqRecord
 import primer3
 import pandas as pd
 import itertools
+import math
 import argparse
 import numpy as np
+import collections
 import concurrent.futures
+import functools
 import sys
 import random
 import requests
@@ -22,7 +25,7 @@ import openpyxl
 
 parser = argparse.ArgumentParser(description='PCR primer design')
 # Define input arguments
-# parser.add_argument('--cpus', type=int, help='number of threads (even though it says cpus)', default=1000)
+parser.add_argument('--cpus', type=int, help='Number of processes to use.', default=os.cpu_count())
 parser.add_argument('--region_file', type=str, help='The path to the primer design region file. Two columns, start position and end position (1-based). tsv or xlxs', required=True)
 parser.add_argument('--input_file', type=str, help="Reference FASTA file", required = True)
 parser.add_argument('--target_tm', type=float, help='The desired melting temperature (Tm) for the primers.', default=65)
@@ -33,7 +36,8 @@ parser.add_argument('--ret', type=int, help='The maximum number of primer pairs
 parser.add_argument('--Q5', action='store_true', help='Whether to use Q5 approximation settings for Tm calculations.', default=True)
 parser.add_argument('--background', type=str, help='The path to the mispriming library FASTA file.', default='')
 parser.add_argument('--output', type=str, help='Output name.', default='MultiPlexPrimerSet')
-parser.add_argument('--eval', type=int, help='The maximum number of primer sets to evaluate.', default=10000)
+parser.add_argument('--eval', type=int, help='The maximum number of primer sets to evaluate (--search sample) or search nodes to expand (--search bnb).', default=10000)
+parser.add_argument('--search', type=str, choices=['cluster', 'sample', 'bnb'], help='How to pick the primer set: clustering, scoring --eval sampled sets, or branch and bound for the highest (least dimer prone) mean heterodimer dG, expanding at most --eval nodes.', default='cluster')
 parser.add_argument('--wiggle', type=int, help='Half the region around the optimal Tm', default=3)
 parser.add_argument('--ill_adapt', action='store_true', help='Add Illumina partial adapters', default=False)
 parser.add_argument('--clamp', type=int, help='Require GC clamp', default=0)
@@ -42,13 +46,14 @@ args = parser.parse_args()
 
 product_size_range = (args.product_size_min, args.product_size_max)
 
-def design_primers(input_file, region_start, region_end, target_tm=args.target_tm, primer_len=20, product_size_range=(400, 800), name='', ret=100, Q5=True, background='', wiggle=args.wiggle, clamp=args.clamp, poly=args.poly):
+def design_primers(seq_id, template, region_start, region_end, target_tm=args.target_tm, primer_len=20, product_size_range=(400, 800), name='', ret=100, Q5=True, background='', wiggle=args.wiggle, clamp=args.clamp, poly=args.poly):
     """
-    This function takes a FASTA file, start and end positions of a target region, and desired melting temperature
-    and primer length, and returns the best primer set for that region using Biopython and primer3.
+    This function takes a reference sequence, start and end positions of a target region, and desired melting temperature
+    and primer length, and returns the best primer set for that region using primer3.
 
     Args:
-    input_file (str): The path to the input FASTA file.
+    seq_id (str): The ID of the reference sequence.
+    template (str): The reference sequence.
     region_start (int): The start position of the target region (1-based).
     region_end (int): The end position of the target region (1-based).
     target_tm (float): The desired melting temperature (Tm) for the primers.
@@ -63,7 +68,7 @@ def design_primers(input_file, region_start, region_end, target_tm=args.target_t
     list: A list of dicts containing information about the primer pairs.
     """
 
-    # Parse the input FASTA file and extract the target region sequence.
+    # Extract the target region sequence.
     # it seems that primer3 doesnt look for non-specificity in the input file, so need to append the target non-regions to the background fasta.
     print("Picking initial primers for " + name)
     # giving issues on some systems because of the -i flag
@@ -89,34 +94,34 @@ def design_primers(input_file, region_start, region_end, target_tm=args.target_t
         file.writelines(new_lines)
 
     if region_start - 10000 > 0:
-        target_seq = input_file.seq[region_start-10000:region_end+10000]
+        target_seq = template[region_start-10000:region_end+10000]
         seq_target = (10000-1, region_end-region_start)
         add_to = 10000
         with open(background, "a") as fasta_file:
             fasta_file.write(">appended_sequence\n")
-            fasta_file.write(str(input_file.seq[0:region_start-10000]) + "\n")
+            fasta_file.write(template[0:region_start-10000] + "\n")
             fasta_file.write(">appended_sequence2\n")
-            fasta_file.write(str(input_file.seq[region_end+10000:]))
+            fasta_file.write(template[region_end+10000:])
     else:
-        target_seq = input_file.seq[0:region_end+10000]
+        target_seq = template[0:region_end+10000]
         seq_target = (region_start-1, region_end-region_start)
         add_to = 0
         with open(background, "a") as fasta_file:
             fasta_file.write(">appended_sequence\n")
-            fasta_file.write(str(input_file.seq[region_end+10000:]) + "\n")
+            fasta_file.write(template[region_end+10000:] + "\n")
             fasta_file.write(">appended_sequence2\n")
             fasta_file.write("gagagagaga")
 
 
-    # target_seq = input_file.seq
+    # target_seq = template
     # seq_target = (region_start-1, region_end-region_start+2)
 
     # shutil.copy(background, "/home/semiquant/Desktop/tmp/tmp.fasta")
 
     # Set up the primer3 input parameters.
     input_params = {
-    'SEQUENCE_ID': input_file.id,
-    'SEQUENCE_TEMPLATE': str(target_seq),
+    'SEQUENCE_ID': seq_id,
+    'SEQUENCE_TEMPLATE': target_seq,
     'SEQUENCE_TARGET': seq_target,
     'PRIMER_OPT_SIZE': primer_len,
     'PRIMER_MIN_SIZE' : 10,
@@ -171,6 +176,7 @@ def design_primers(input_file, region_start, region_end, target_tm=args.target_t
                 global_args.update({'PRIMER_MIN_SIZE': 5,})
                 global_args.update({'PRIMER_MAX_SIZE': 36,})
                 primers = primer3.bindings.designPrimers(input_params, global_args)
+    primer_pairs = []
     try:
         # Check if any primer pairs were returned.
         if 'PRIMER_PAIR_NUM_RETURNED' not in primers or primers['PRIMER_PAIR_NUM_RETURNED'] == 0:
@@ -178,72 +184,231 @@ def design_primers(input_file, region_start, region_end, target_tm=args.target_t
         else:
             if no_miss:
                 print("No mispriming library used for " + name)
+            # Check that the product size is within the specified range.
+            # if product_size < int(product_size_range[0]) or product_size > int(product_size_range[1]):
+            if args.ill_adapt:
+                # add illumina partial adapter, dont adjust Tm as these are tails
+                forward_tail = "ACACTCTTTCCCTACACGACGCTCTTCCGATCT"
+                reverse_tail = "GACTGGAGTTCAGACGTGTGCTCTTCCGATCT"
+            else:
+                forward_tail = reverse_tail = ""
             # Extract information about the primer pairs.
-            primer_pairs = []
-            for i in range(primers['PRIMER_PAIR_NUM_RETURNED']):
-                forward_seq = primers[f'PRIMER_LEFT_{i}_SEQUENCE']
-                reverse_seq = primers[f'PRIMER_RIGHT_{i}_SEQUENCE']
-                forward_tm = primers[f'PRIMER_RIGHT_{i}_TM']
-                reverse_tm = primers[f'PRIMER_LEFT_{i}_TM']
-                product_size = primers[f'PRIMER_PAIR_{i}_PRODUCT_SIZE']
-                start = primers['PRIMER_LEFT_{}'.format(i)][0] + region_start - add_to
-                end = primers['PRIMER_RIGHT_{}'.format(i)][0] + region_start - add_to
-
-                # Check that the product size is within the specified range.
-                # if product_size < int(product_size_range[0]) or product_size > int(product_size_range[1]):
-                if args.ill_adapt:
-                    # add illumina partial adapter, dont adjust Tm as these are tails
-                    forward_seq = "ACACTCTTTCCCTACACGACGCTCTTCCGATCT" + forward_seq
-                    reverse_seq = "GACTGGAGTTCAGACGTGTGCTCTTCCGATCT" + reverse_seq
-                primer_pairs.append({
-                    'Forward Primer': forward_seq,
-                    'Reverse Primer': reverse_seq,
-                    'Forward tm': forward_tm,
-                    'Reverse tm': reverse_tm,
-                    'Product Size': product_size,
-                    'Binding Start': str(start),
-                    'Binding End': str(end),
-                    'name': name
-                    })
+            primer_pairs = [{
+                'Forward Primer': forward_tail + primers[f'PRIMER_LEFT_{i}_SEQUENCE'],
+                'Reverse Primer': reverse_tail + primers[f'PRIMER_RIGHT_{i}_SEQUENCE'],
+                'Forward tm': primers[f'PRIMER_LEFT_{i}_TM'],
+                'Reverse tm': primers[f'PRIMER_RIGHT_{i}_TM'],
+                'Product Size': primers[f'PRIMER_PAIR_{i}_PRODUCT_SIZE'],
+                'Binding Start': str(primers[f'PRIMER_LEFT_{i}'][0] + region_start - add_to),
+                'Binding End': str(primers[f'PRIMER_RIGHT_{i}'][0] + region_start - add_to),
+                'name': name
+                } for i in range(primers['PRIMER_PAIR_NUM_RETURNED'])]
     except Exception as e:
         print("An error occurred:", e)
 
     return primer_pairs
 
+# reference id and sequence for the design workers, set once per worker so tasks don't carry the genome
+reference = ('', '')
+
+def init_reference(seq_id, template):
+    global reference
+    reference = (seq_id, template)
+
+def design_worker(kwargs):
+    # top level so ProcessPoolExecutor.map can pickle it, unpacks one design_primers call against the worker's reference
+    # design_primers fills the background with most of the reference, so each region gets its own copy that is removed as soon as it's done
+    with tempfile.TemporaryDirectory() as tmp_back_n:
+        # copy background fasta
+        if args.background != '':
+            shutil.copy(args.background, tmp_back_n)
+            tmp_back = os.path.join(tmp_back_n, os.path.basename(args.background))
+        else:
+            tmp_back = os.path.join(tmp_back_n, 'no_back.fasta')
+
+        # add two random lines for initialization
+        with open(tmp_back, "a") as fasta_file:
+            fasta_file.write(">appended_rdm_sequence1\n")
+            fasta_file.write("gcagcagtcgctcgatccgat" + "\n")
+            fasta_file.write(">appended_rdm_sequence2\n")
+            fasta_file.write("gcagcagtcggagatagacctcgatccgat")
+
+        return design_primers(*reference, background=tmp_back, **kwargs)
+
 def q5_melting_temp(seq1, seq2="", salt=0.5):
     url = "https://tmapi.neb.com/tm/q5/%s/%s/%s?&fmt=short" % (salt, seq1, seq2)
-    response = requests.get(url)
-    json_string = response.json()
-    tm1 = json_string["data"]["tm1"]
-    # tm2 = json_string["data"]["tm2"]
+    try:
+        response = requests.get(url, timeout=30)
+        json_string = response.json()
+        tm1 = json_string["data"]["tm1"]
+        # tm2 = json_string["data"]["tm2"]
+    except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+        # the NEB Tm is only informative, so don't lose the primer set at the end of a long search if the API is unavailable
+        print("NEB Tm lookup failed for " + seq1 + ": " + str(e))
+        return None
     return tm1 #[tm1, tm2]
 
-def is_valid_combination(combination, names):
-    if set(entry['name'] for entry in combination) == names:
-        return combination
-    return []
-
-def evaluate_combination(comb, Q5=args.Q5):
-    # Create a list of primer pairs
-    primer_pairs = [(p1, p2) for p1, p2 in itertools.combinations(comb, 2)]
-    # Extract the primer sequences from the primer pairs
-    primer_pairs_sequences = [(p1['Forward Primer'], p2['Reverse Primer']) for p1, p2 in primer_pairs]
-    # Calculate heterodimer formation energy
-    heterodimer_scores = []
-    for p in primer_pairs_sequences:
-        if Q5:
-            heterodimer_scores.append(primer3.calcHeterodimer(p[0], p[1], temp_c=args.target_tm, dv_conc = 2, mv_conc = 70, dna_conc = 3300).dg) #gibbs free energy
-        else:
-            heterodimer_scores.append(primer3.calcHeterodimer(p[0], p[1], temp_c=args.target_tm).dg) #gibbs free energy
-    product_size_weight=0.2
-    heterodimer_score_weight =0.8
-    score = {'size': product_size_range,
-             'tmp': tm_range,
-             'mean': np.mean(heterodimer_scores),
-             'range': abs(np.min(heterodimer_scores)) - abs(np.max(heterodimer_scores))
-             # 'weighted_score': product_size_weight * (1 - product_size_range) + heterodimer_score_weight * (1 - abs(np.mean(heterodimer_scores)) / 100)
-            }    
-    return score, comb
+# struct of arrays view of the primer pool, plus the heterodimer dG of forward primer p against reverse primer q,
+# shared read-only with the scoring workers
+pool_arrays = {}
+
+def init_pool_arrays(arrays):
+    global pool_arrays
+    pool_arrays = arrays
+
+def primer_arrays(primers, name_ids):
+    # split the primer dicts into one array per field, so combinations can be scored as arrays of primer indices
+    return {'product_size': np.array([d['Product Size'] for d in primers], dtype=np.int32),
+            'forward_tm': np.array([d['Forward tm'] for d in primers], dtype=np.float32),
+            'reverse_tm': np.array([d['Reverse tm'] for d in primers], dtype=np.float32),
+            'forward_seq': np.array([d['Forward Primer'] for d in primers], dtype=object),
+            'reverse_seq': np.array([d['Reverse Primer'] for d in primers], dtype=object),
+            'name_id': np.array([name_ids[d['name']] for d in primers], dtype=np.int32)
+           }
+
+def batched(iterable, n):
+    # split an iterable into tuples of up to n items without materialising it
+    iterator = iter(iterable)
+    while batch := tuple(itertools.islice(iterator, n)):
+        yield batch
+
+def chunk_size(n_items, cpus=args.cpus):
+    # about 8 chunks per process: enough to balance the load, few enough that the IPC per chunk is amortised
+    return max(1, n_items // (cpus * 8))
+
+def heterodimer_dg_batch(pairs, target_tm=args.target_tm, Q5=args.Q5):
+    # one ThermoAnalysis for the whole batch, rather than primer3 setting up its parameters again on every call
+    if Q5:
+        thermo = primer3.thermoanalysis.ThermoAnalysis(temp_c=target_tm, dv_conc=2, mv_conc=70, dna_conc=3300)
+    else:
+        thermo = primer3.thermoanalysis.ThermoAnalysis(temp_c=target_tm)
+    # calc_heterodimer is order sensitive, so score both orientations and keep the worst case (lowest dG)
+    return [min(thermo.calc_heterodimer(seq1, seq2).dg, thermo.calc_heterodimer(seq2, seq1).dg) for seq1, seq2 in pairs] #gibbs free energy
+
+def heterodimer_dgs(pairs, target_tm=args.target_tm, Q5=args.Q5, cpus=args.cpus):
+    # heterodimer scoring is CPU bound, so use processes rather than threads to get around the GIL
+    batch_dg = functools.partial(heterodimer_dg_batch, target_tm=target_tm, Q5=Q5)
+    batches = batched(pairs, chunk_size(len(pairs), cpus))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=cpus) as executor:
+        return np.fromiter(itertools.chain.from_iterable(executor.map(batch_dg, batches)), dtype=np.float32, count=len(pairs))
+
+def pair_dgs(arrays, ps, qs):
+    # dG of forward primer ps[k] against reverse primer qs[k], for every k
+    # the same primer sequences turn up in many primer pairs, so calculate each unique pair of sequences once
+    # every distinct sequence gets an integer id and an unordered pair of sequences is keyed by a single integer
+    n_primers = len(arrays['forward_seq'])
+    seqs, seq_ids = np.unique(np.concatenate((arrays['forward_seq'], arrays['reverse_seq'])), return_inverse=True)
+    forward_ids = seq_ids[:n_primers][ps].astype(np.int64)
+    reverse_ids = seq_ids[n_primers:][qs].astype(np.int64)
+    keys = np.minimum(forward_ids, reverse_ids) * len(seqs) + np.maximum(forward_ids, reverse_ids)
+    unique_keys, first, pair_ids = np.unique(keys, return_index=True, return_inverse=True)
+    print("Calculating heterodimer dG for ", len(unique_keys), " primer pairs")
+    dg = heterodimer_dgs([(arrays['forward_seq'][ps[k]], arrays['reverse_seq'][qs[k]]) for k in first])
+    return dg[pair_ids.reshape(-1)].astype(np.float32)
+
+def sample_combinations(groups, n_eval, seed):
+    # lazily yield the combinations to score as tuples of primer indices, one from each group
+    # the same seed gives the same combinations
+    if math.prod(len(group) for group in groups) <= n_eval:
+        # small enough to search exhaustively
+        yield from itertools.product(*groups)
+    else:
+        rng = random.Random(seed)
+        for i in range(n_eval):
+            yield tuple(rng.choice(group) for group in groups)
+
+def stream_map(executor, fn, items, prepare, window):
+    # like executor.map, but only keeps window tasks in flight so items can be a lazy generator
+    # yields (item, fn(prepare(item))) in order
+    pending = collections.deque()
+    for item in items:
+        pending.append((item, executor.submit(fn, prepare(item))))
+        if len(pending) >= window:
+            item, future = pending.popleft()
+            yield item, future.result()
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+def evaluate_combinations(idx):
+    # top level so it can be pickled into ProcessPoolExecutor workers
+    # idx holds one combination of primer indices per row, the whole batch is scored with a few vectorised reductions
+    # the forward primer of each earlier target is paired with the reverse primer of each later target
+    # pair_keys holds the sorted keys p * n_primers + q of the scored primer pairs, pair_dg their dG
+    i, j = np.triu_indices(idx.shape[1], 1)
+    keys = idx[:, i].astype(np.int64) * len(pool_arrays['product_size']) + idx[:, j]
+    heterodimer_scores = pool_arrays['pair_dg'][np.searchsorted(pool_arrays['pair_keys'], keys)]
+    tm_values = np.concatenate((pool_arrays['forward_tm'][idx], pool_arrays['reverse_tm'][idx]), axis=1)
+    score = {'size': np.ptp(pool_arrays['product_size'][idx], axis=1),
+             'tmp': np.ptp(tm_values, axis=1),
+             'mean': heterodimer_scores.mean(axis=1),
+             'range': np.abs(heterodimer_scores.min(axis=1)) - np.abs(heterodimer_scores.max(axis=1))
+            }
+    return score
+
+
+def branch_and_bound(cost_mats, group_sizes, max_nodes=float('inf')):
+    """
+    Finds the combination, one primer per target, with the lowest total pairwise cost.
+    Targets are fixed in order and a node is pruned once its lower bound can no longer beat the best set found so far.
+
+    Args:
+    cost_mats (dict): Maps target indices (i, j), i < j, to an array of costs for the forward primers of i against the reverse primers of j.
+    group_sizes (list): The number of candidate primers for each target.
+    max_nodes (int): The maximum number of nodes to expand, the best set found so far is returned once it is reached.
+
+    Returns:
+    tuple: The total cost of the best combination, the index of the chosen primer within each target,
+    and whether the search finished (so the combination is optimal) within max_nodes.
+    """
+    n = len(group_sizes)
+    # the lowest cost each primer of target i can reach against any primer of target j, and between any two primers of i and j
+    row_min = {key: cost.min(axis=1) for key, cost in cost_mats.items()}
+    pair_min = {key: cost.min() for key, cost in cost_mats.items()}
+    # per target lower bound tables: the best each candidate of target d can do against the targets after d + 1,
+    # and the best any pair of targets after d can do
+    future_lb = [sum((row_min[d, j] for j in range(d + 2, n)), np.zeros(group_sizes[d])) for d in range(n - 1)]
+    free_lb = [sum(pair_min[i, j] for i in range(d + 1, n) for j in range(i + 1, n)) for d in range(n - 1)]
+
+    best_total = float('inf')
+    best_idx = None
+    nodes = 0
+    complete = True
+
+    def descend(chosen, partial):
+        nonlocal best_total, best_idx, nodes, complete
+        nodes += 1
+        d = len(chosen)
+        # exact cost of each candidate for target d against the fixed targets
+        costs = partial + sum((cost_mats[i, d][chosen[i]] for i in range(d)), np.zeros(group_sizes[d]))
+        # the next target is bounded jointly rather than pair by pair: its best primer given each candidate for d
+        next_costs = cost_mats[d, d + 1] + sum((cost_mats[i, d + 1][chosen[i]] for i in range(d)), np.zeros(group_sizes[d + 1]))
+        next_best = next_costs.min(axis=1)
+        if d == n - 2:
+            # nothing is left to bound, so the bound is exact and the cheapest candidate completes the best set below this node
+            a = np.argmin(costs + next_best)
+            if costs[a] + next_best[a] < best_total:
+                best_total = costs[a] + next_best[a]
+                best_idx = tuple(chosen) + (a, np.argmin(next_costs[a]))
+            return
+        # bound every candidate for target d at once and expand the most promising first,
+        # so the first descent finds a strong set to prune against
+        fixed_lb = sum(row_min[i, j][chosen[i]] for i in range(d) for j in range(d + 2, n))
+        bounds = costs + next_best + future_lb[d] + (fixed_lb + free_lb[d])
+        for a in np.argsort(bounds, kind='stable'):
+            if bounds[a] >= best_total:
+                # the remaining candidates have equal or higher bounds
+                break
+            if nodes >= max_nodes and best_idx is not None:
+                # out of budget, keep the best set found so far
+                complete = False
+                break
+            chosen.append(a)
+            descend(chosen, costs[a])
+            chosen.pop()
+
+    descend([], 0.0)
+    return best_total, best_idx, complete
 
 
 # Define the features to consider for clustering
@@ -359,9 +524,8 @@ def main():
     modified_names = {}
 
     primers_all = []
-
-    record = SeqIO.read(args.input_file, "fasta")
-
+    tasks = []
+    region_names = []
 
     # check if regions overlap
     # Sort the DataFrame by 'start' column
@@ -375,12 +539,12 @@ def main():
 
     # Iterate over each row
     # from tqdm import tqdm
-    # for index, row in tqdm(df.iterrows(), total=len(df)):
-    for index, row in df.iterrows():
+    # for row in tqdm(df.itertuples(index=False), total=len(df)):
+    for row in df.itertuples(index=False):
         # Access the "start" and "end" values using the column names
-        # name=str(row['name'])
-        start = int(row['start'])
-        end = int(row['end'])
+        # name=str(row.name)
+        start = int(row.start)
+        end = int(row.end)
         name = 'Target ' + str(start) + "-" + str(end)
 
         if end - start > int(product_size_range[1]):
@@ -395,26 +559,19 @@ def main():
             else:
                 modified_name = name + '_' + str(random.randint(1, 100))
                 modified_names[name] = modified_name
-            # Update name in row
-            df.at[index, 'name'] = modified_name
             seen_names.add(modified_name)
             name = modified_name
         else:
             seen_names.add(name)
+        region_names.append(name)
 
-        # copy background fasta
-        tmp_dir = tempfile.TemporaryDirectory()
-        tmp_back_n = tmp_dir.name
-        if args.background != '':
-            shutil.copy(args.background, tmp_back_n)
-            tmp_back = os.path.join(tmp_back_n, os.path.basename(args.background))
-        else:
-            tmp_back = os.path.join(tmp_back_n, 'no_back.fasta')
-            # with open(tmp_back, "a") as fasta_file:
-            #     fasta_file.write(">random_testing\n")
-            #     fasta_file.write("gcaggcaggcaggcag" + "\n")
-            #     fasta_file.write(">random_testing2\n")
-            #     fasta_file.write("gcaggcaggcaggccag" + "\n")
+        # the background fasta is copied by design_worker, one temporary copy per region while it is designed
+
+        # with open(tmp_back, "a") as fasta_file:
+        #     fasta_file.write(">random_testing\n")
+        #     fasta_file.write("gcaggcaggcaggcag" + "\n")
+        #     fasta_file.write(">random_testing2\n")
+        #     fasta_file.write("gcaggcaggcaggccag" + "\n")
         #     # Create a temporary file for writing
         #     with tempfile.NamedTemporaryFile(delete=False) as tmp_back:
         #         # You can write to the temporary file as needed
@@ -446,13 +603,6 @@ def main():
         #         # write an empty string to the file
         #         tmp_back.write(b'')
 
-        # add two random lines for initialization
-        with open(tmp_back, "a") as fasta_file:
-            fasta_file.write(">appended_rdm_sequence1\n")
-            fasta_file.write("gcagcagtcgctcgatccgat" + "\n")
-            fasta_file.write(">appended_rdm_sequence2\n")
-            fasta_file.write("gcagcagtcggagatagacctcgatccgat")
-
         # # Read the content of tmp_back and filter out blank lines, in case there were in the input file
         # with open(tmp_back, "r") as fasta_file:
         #     lines = fasta_file.readlines()
@@ -462,25 +612,28 @@ def main():
         # with open(tmp_back, "w") as fasta_file:
         #     fasta_file.write("\n".join(filtered_lines))
 
-        # Call the design_primers function to design primers for the target region.
-        primer_tmp = []
-        primer_tmp = design_primers(
-            input_file=record,
-            region_start=start,
-            region_end=end,
-            target_tm=args.target_tm,
-            primer_len=args.primer_len,
-            product_size_range=product_size_range,
-            name=name,
-            ret=args.ret,
-            Q5=args.Q5,
-            background=tmp_back
-            )
-
-        if primer_tmp is not None and len(primer_tmp) > 0:
-            primers_all.append(primer_tmp)
-        else:
-            print("No primer found for: " + name)
+        # Queue a design_primers call for the target region.
+        tasks.append({
+            'region_start': start,
+            'region_end': end,
+            'target_tm': args.target_tm,
+            'primer_len': args.primer_len,
+            'product_size_range': product_size_range,
+            'name': name,
+            'ret': args.ret,
+            'Q5': args.Q5
+            })
+
+    df['name'] = region_names
+
+    # regions are independent, so design them in parallel, the reference is parsed once and handed to each worker up front
+    record = SeqIO.read(args.input_file, "fasta")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.cpus, initializer=init_reference, initargs=(record.id, str(record.seq))) as executor:
+        for task, primer_tmp in zip(tasks, executor.map(design_worker, tasks)):
+            if primer_tmp is not None and len(primer_tmp) > 0:
+                primers_all.append(primer_tmp)
+            else:
+                print("No primer found for: " + task['name'])
         
 
 
@@ -495,7 +648,6 @@ def main():
             flat_list.append(item)
 
     primers_all = flat_list
-    cluster_method = True
 
     names = set([primer['name'] for primer in primers_all])  # get unique names
     if len(names) <= 1:
@@ -503,46 +655,77 @@ def main():
         exit(1)
     else:
         print("Finding best primer set for the following targets: " + ', '.join(map(str, names)))
-        if cluster_method:
+        name_ids = {name: k for k, name in enumerate(sorted(names))}
+        arrays = primer_arrays(primers_all, name_ids)
+        # indices of the candidate primers for each target, so every combination takes exactly one primer from each group
+        groups = [np.flatnonzero(arrays['name_id'] == k) for k in range(len(name_ids))]
+        # visit the primers closest to the target Tm first, this orders the exhaustive search and breaks ties between equal bounds in bnb
+        tm_offset = np.abs(arrays['forward_tm'] - args.target_tm) + np.abs(arrays['reverse_tm'] - args.target_tm)
+        groups = [group[np.argsort(tm_offset[group], kind='stable')] for group in groups]
+        if args.search == 'cluster':
             best_comb = cluster_primers(primers_all)
+        elif args.search == 'bnb':
+            # dG of every forward primer against the reverse primers of each later target, one block per pair of targets
+            blocks = [((i, j), np.meshgrid(group1, group2, indexing='ij')) for (i, group1), (j, group2) in itertools.combinations(enumerate(groups), 2)]
+            dg = pair_dgs(arrays, np.concatenate([ps.ravel() for _, (ps, qs) in blocks]), np.concatenate([qs.ravel() for _, (ps, qs) in blocks]))
+            # a lower dG means a dimer is more likely, so search on -dG to find the set with the highest mean dG
+            cost_mats = {}
+            offset = 0
+            for key, (ps, qs) in blocks:
+                cost_mats[key] = -dg[offset:offset + ps.size].reshape(ps.shape).astype(np.float64)
+                offset += ps.size
+
+            best_total, best_idx, complete = branch_and_bound(cost_mats, [len(group) for group in groups], max_nodes=args.eval)
+            best_comb = [primers_all[group[a]] for group, a in zip(groups, best_idx)]
+            if not complete:
+                print("Search stopped after ", args.eval, " nodes (--eval), the set found may not be optimal")
+            print("Highest mean heterodimer dG: ", -best_total / len(cost_mats))
         else:
-            best_score = {'mean': float('inf'), 'range': float('inf'), 'tmp': float('inf'), 'size': float('inf')}
-            best_comb = None
-            valid_combinations = []
-            pos = 0
-            name_primers_dict = {}
-            for name in names:
-                name_primers_dict[name] = [primer for primer in primers_all if primer['name'] == name]  # group primers by name
-
-            combinations = []
-            for i in range(args.eval):
-                combination = []
-                for name in names:
-                    name_primers = name_primers_dict[name]  # get primers for the current name
-                    combination.append(random.choice(name_primers))
-                combinations.append(combination)
-
-            print("Picking best set from: ", len(combinations), " combinations")
-            # tm and size
-            product_sizes = [d['Product Size'] for d in primers_all]
-            tm_values = [d['Forward tm'] for d in primers_all] + [d['Reverse tm'] for d in primers_all]
-            # product_size_range = max(product_sizes) - min(product_sizes)
-            tm_range = max(tm_values) - min(tm_values)
-            best_score = {'mean': float('inf'), 'range': float('inf'), 'tmp': float('inf')}
+            # combinations are generated lazily, twice from the same seed: once to find the primer pairs, once to score them
+            seed = random.randrange(2**32)
+            # a lower dG means a dimer is more likely, so the set with the highest mean dG is kept
+            best_score = {'mean': -float('inf'), 'range': float('inf'), 'tmp': float('inf')}
             best_comb = None
 
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                futures = [executor.submit(evaluate_combination, comb) for comb in combinations]
-
-                for future in concurrent.futures.as_completed(futures):
-                    score, comb = future.result()
-                    if best_score['mean'] > score['mean']:
-                        if best_score['range'] * 0.9 > score['range']:
-                            best_score = score
-                            best_comb = comb
-                        elif best_score['tmp'] > 4 or score['tmp'] > 4 and best_score['tmp'] > score['tmp']:
-                            best_score = score
-                            best_comb = comb
+            # collect the (forward, reverse) primer pairs the sampled combinations use, keyed p * n_primers + q
+            i, j = np.triu_indices(len(groups), 1)
+            n_primers = len(primers_all)
+            batch_keys = []
+            n_combinations = 0
+            for batch in batched(sample_combinations(groups, args.eval, seed), chunk_size(args.eval)):
+                idx = np.array(batch, dtype=np.int32)
+                batch_keys.append(np.unique(idx[:, i].astype(np.int64) * n_primers + idx[:, j]))
+                n_combinations += len(idx)
+            # merge once at the end, rather than re-sorting the growing key set for every batch
+            pair_keys = np.unique(np.concatenate(batch_keys))
+            print("Picking best set from: ", n_combinations, " combinations")
+            # the workers only get the fields they score and the dG of the pairs in use
+            score_arrays = {'product_size': arrays['product_size'],
+                            'forward_tm': arrays['forward_tm'],
+                            'reverse_tm': arrays['reverse_tm'],
+                            'pair_keys': pair_keys,
+                            'pair_dg': pair_dgs(arrays, pair_keys // n_primers, pair_keys % n_primers)
+                           }
+
+            # score the combinations in batches, each batch is a handful of vectorised reductions
+            batches = batched(sample_combinations(groups, args.eval, seed), chunk_size(n_combinations))
+            completed = 0
+            with concurrent.futures.ProcessPoolExecutor(max_workers=args.cpus, initializer=init_pool_arrays, initargs=(score_arrays,)) as executor:
+                for batch, scores in stream_map(executor, evaluate_combinations, batches, lambda batch: np.array(batch, dtype=np.int32), args.cpus * 2):
+                    # one pass over the batch on plain floats, a score dict is only built for a new best set
+                    for comb, size, tmp, mean, range_ in zip(batch, scores['size'].tolist(), scores['tmp'].tolist(), scores['mean'].tolist(), scores['range'].tolist()):
+                        if best_score['mean'] < mean:
+                            if best_score['range'] * 0.9 > range_:
+                                best_score = {'size': size, 'tmp': tmp, 'mean': mean, 'range': range_}
+                                best_comb = comb
+                            elif best_score['tmp'] > 4 or tmp > 4 and best_score['tmp'] > tmp:
+                                best_score = {'size': size, 'tmp': tmp, 'mean': mean, 'range': range_}
+                                best_comb = comb
+                    # report progress once per batch rather than per combination
+                    completed += len(batch)
+                    sys.stdout.write(f"\rProgress {completed / n_combinations * 100:.1f}%")
+                    sys.stdout.flush()
+            best_comb = [primers_all[k] for k in best_comb]
             
         ######
         print("")
@@ -556,8 +739,6 @@ def main():
         best_comb.to_excel(args.output + '.xlsx', sheet_name='PrimerSet', index=False, engine='openpyxl') 
 
 
-    tmp_dir.cleanup()
-
 # (plt, tab) = plot_cluster(clusterer, primers)
 # print(tab)
 